@@ -1,4 +1,7 @@
 import re
+import sys
+from functools import lru_cache
+from operator import itemgetter
 from urllib.parse import urlparse
 
 from tinycss2.nth import parse_nth
@@ -10,6 +13,16 @@ from .parser import SelectorError
 # http://dev.w3.org/csswg/selectors/#whitespace
 split_whitespace = re.compile('[^ \t\r\n\f]+').findall
 
+# Test functions, by source
+_TEST_CACHE = {}
+_TEST_CACHE_SIZE = 4096
+
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+_xhtml_tags = {}
+
+# Attribute names that can be used in XPath expressions
+_xpath_attribute_name = re.compile('[A-Za-z_][A-Za-z0-9_.-]*$').match
+
 
 def compile_selector_list(input, namespaces=None):
     """Compile a (comma-separated) list of selectors.
@@ -26,25 +39,109 @@ def compile_selector_list(input, namespaces=None):
         If omitted, assume that no prefix is declared.
     :returns:
         A list of opaque :class:`compiler.CompiledSelector` objects.
+        Selectors that never match (such as ``:hover``) are not included,
+        use :func:`compile_selector_list_all` to get them too.
+
+    Strings are compiled once: compiling the same string again with the same
+    namespaces returns the same :class:`compiler.CompiledSelector` objects.
 
     """
     return [
-        CompiledSelector(selector)
-        for selector in parser.parse(input, namespaces)
-    ]
+        selector for selector in compile_selector_list_all(input, namespaces)
+        if not selector.never_matches]
+
+
+def compile_selector_list_all(input, namespaces=None):
+    """Same as :func:`compile_selector_list`, but keep all the selectors.
+
+    Selectors that never match are included, keeping the order of the list.
+
+    """
+    if isinstance(input, str):
+        namespaces = frozenset(namespaces.items()) if namespaces else None
+        return list(_compile_string(input, namespaces))
+    return _compile_selectors(parser.parse(input, namespaces))
+
+
+@lru_cache(maxsize=1024)
+def _compile_string(input, namespaces):
+    return tuple(_compile_selectors(_parse_string(input, namespaces)))
+
+
+@lru_cache(maxsize=4096)
+def _parse_string(input, namespaces):
+    # Parsed selectors are only read by the compiler, they can be shared.
+    namespaces = dict(namespaces) if namespaces else None
+    return tuple(parser.parse(input, namespaces))
+
+
+def _compile_selectors(parsed_selectors):
+    """Compile parsed selectors, building all their tests at once."""
+    parsed_selectors = list(parsed_selectors)
+    sources = [
+        _compile_node(selector.parsed_tree) for selector in parsed_selectors]
+    tests = _compile_tests(sources)
+    return [
+        CompiledSelector(selector, source, test)
+        for selector, source, test in zip(parsed_selectors, sources, tests)]
+
+
+# Element attributes read more than once by a test (parent, previous,
+# etree_element…) are not stored in local variables: rewriting the generated
+# functions to do so makes compilation about 3 times slower, without making
+# matching faster.
+def _compile_tests(sources):
+    """Return test functions for sources generated by :func:`_compile_node`.
+
+    All the functions are compiled in a single module, sharing the same
+    globals. Functions are shared by all the selectors with the same source.
+
+    """
+    tests = {'0': _never_match}
+    missing = []
+    for source in sources:
+        if source not in tests:
+            # Read the shared cache once, as it can be cleared by other threads
+            tests[source] = test = _TEST_CACHE.get(source)
+            if test is None:
+                missing.append(source)
+    if missing:
+        module = ''.join(
+            'def _s%i(el):\n    return %s\n' % (i, source)
+            for i, source in enumerate(missing))
+        namespace = {}
+        exec(compile(module, '<selectors>', 'exec'), _EVAL_GLOBALS, namespace)
+        if len(_TEST_CACHE) + len(missing) > _TEST_CACHE_SIZE:
+            _TEST_CACHE.clear()
+        for i, source in enumerate(missing):
+            tests[source] = _TEST_CACHE[source] = namespace['_s%i' % i]
+    return [tests[source] for source in sources]
+
+
+def _never_match(el):
+    return 0
 
 
 class CompiledSelector:
     """Abstract representation of a selector."""
-    def __init__(self, parsed_selector):
-        source = _compile_node(parsed_selector.parsed_tree)
+    __slots__ = (
+        'never_matches', 'test', 'xpath', 'trivial', 'specificity',
+        'pseudo_element', 'id', 'class_name', 'local_name', 'lower_local_name',
+        'namespace', 'requires_lang_attr')
+
+    def __init__(self, parsed_selector, source=None, test=None):
+        if source is None:
+            source = _compile_node(parsed_selector.parsed_tree)
         self.never_matches = source == '0'
-        eval_globals = {
-            'split_whitespace': split_whitespace,
-            'ascii_lower': ascii_lower,
-            'urlparse': urlparse,
-        }
-        self.test = eval('lambda el: ' + source, eval_globals, {})
+        if test is None:
+            test, = _compile_tests([source])
+        self.test = test
+        # XPath predicate equivalent to the test, or None when the selector
+        # can't be translated.
+        self.xpath = _try_xpath(parsed_selector.parsed_tree)
+        # True when the test is implied by the ID or the class name, so that
+        # callers indexing selectors on these values can skip it.
+        self.trivial = False
         self.specificity = parsed_selector.specificity
         self.pseudo_element = parsed_selector.pseudo_element
         self.id = None
@@ -70,6 +167,235 @@ class CompiledSelector:
             elif isinstance(simple_selector, parser.AttributeSelector) and \
                     simple_selector.name == "lang":
                 self.requires_lang_attr = True
+        if node is parsed_selector.parsed_tree and \
+                len(node.simple_selectors) == 1:
+            self.trivial = isinstance(
+                node.simple_selectors[0],
+                (parser.IDSelector, parser.ClassSelector))
+
+
+class SelectorIndex:
+    """Compiled selectors indexed by ID, class name, local name and namespace.
+
+    Only the selectors whose ID, class name, local name or namespace can match
+    an element are tested against this element.
+
+    :param selectors:
+        An iterable of :class:`compiler.CompiledSelector` objects.
+        Selectors that never match are ignored.
+
+    """
+    def __init__(self, selectors=()):
+        self.id_selectors = {}
+        self.class_selectors = {}
+        self.lower_local_name_selectors = {}
+        self.namespace_selectors = {}
+        self.lang_attr_selectors = []
+        self.other_selectors = []
+        for order, selector in enumerate(selectors):
+            self.add_selector(selector, (order, selector))
+
+    def add_selector(self, selector, payload):
+        """Add a selector and its payload to the index.
+
+        :param selector:
+            A :class:`compiler.CompiledSelector` object.
+        :param payload:
+            Some data associated to the selector, returned for the elements
+            matching the selector.
+
+        """
+        if selector.never_matches:
+            return
+
+        # Trivial selectors are stored with their ID or class name, that is
+        # checked before calling the test.
+        test = None if selector.trivial else selector.test
+        entry = (test, payload)
+        if selector.id is not None:
+            self.id_selectors.setdefault(selector.id, []).append(entry)
+        elif selector.class_name is not None:
+            self.class_selectors.setdefault(selector.class_name, []) \
+                .append(entry)
+        elif selector.local_name is not None:
+            self.lower_local_name_selectors.setdefault(
+                selector.lower_local_name, []).append(entry)
+        elif selector.namespace is not None:
+            self.namespace_selectors.setdefault(selector.namespace, []) \
+                .append(entry)
+        elif selector.requires_lang_attr:
+            self.lang_attr_selectors.append(entry)
+        else:
+            self.other_selectors.append(entry)
+
+    def _candidates(self, element):
+        """Yield the lists of entries whose selectors can match element."""
+        if self.id_selectors and element.id in self.id_selectors:
+            yield self.id_selectors[element.id]
+        if self.class_selectors:
+            for class_name in element.classes:
+                if class_name in self.class_selectors:
+                    yield self.class_selectors[class_name]
+        if self.lower_local_name_selectors:
+            lower_name = ascii_lower(element.local_name)
+            if lower_name in self.lower_local_name_selectors:
+                yield self.lower_local_name_selectors[lower_name]
+        if element.namespace_url in self.namespace_selectors:
+            yield self.namespace_selectors[element.namespace_url]
+        if self.lang_attr_selectors and \
+                'lang' in element.etree_element.attrib:
+            yield self.lang_attr_selectors
+        yield self.other_selectors
+
+    def _payloads(self, element):
+        """Return the payloads of the selectors matching element."""
+        payloads = []
+        for entries in self._candidates(element):
+            for test, payload in entries:
+                if test is None or test(element):
+                    payloads.append(payload)
+        return payloads
+
+    def match(self, element):
+        """Return the selectors matching the given element.
+
+        :param element:
+            An :class:`ElementWrapper`.
+        :returns:
+            A list of :class:`compiler.CompiledSelector` objects, in the order
+            they were given.
+
+        """
+        payloads = self._payloads(element)
+        payloads.sort(key=_ORDER_KEY)
+        return [selector for _, selector in payloads]
+
+    def matches(self, element):
+        """Return whether any selector matches the given element.
+
+        :param element:
+            An :class:`ElementWrapper`.
+
+        """
+        for entries in self._candidates(element):
+            for test, _ in entries:
+                if test is None or test(element):
+                    return True
+        return False
+
+
+_ORDER_KEY = itemgetter(0)
+
+
+def _includes_word(value, word):
+    # The substring test is much cheaper than splitting, and rejects most of
+    # the values. str.split() can't be used as it splits on characters that
+    # are not whitespace in CSS.
+    return word in value and word in split_whitespace(value)
+
+
+def _any_ancestor(el, test):
+    # Walk the parents instead of building the "ancestors" tuple.
+    el = el.parent
+    while el is not None:
+        if test(el):
+            return True
+        el = el.parent
+    return False
+
+
+def _any_previous_sibling(el, test):
+    el = el.previous
+    while el is not None:
+        if test(el):
+            return True
+        el = el.previous
+    return False
+
+
+def _first_of_type(el):
+    tag = el.etree_element.tag
+    for sibling in el.etree_siblings[:el.index]:
+        if sibling.tag == tag:
+            return False
+    return True
+
+
+def _last_of_type(el):
+    tag = el.etree_element.tag
+    for sibling in el.etree_siblings[el.index + 1:]:
+        if sibling.tag == tag:
+            return False
+    return True
+
+
+def _only_of_type(el):
+    tag = el.etree_element.tag
+    index = el.index
+    for i, sibling in enumerate(el.etree_siblings):
+        if sibling.tag == tag and i != index:
+            return False
+    return True
+
+
+def _count_previous_of_type(el):
+    tag = el.etree_element.tag
+    count = 0
+    for sibling in el.etree_siblings[:el.index]:
+        if sibling.tag == tag:
+            count += 1
+    return count
+
+
+def _count_next_of_type(el):
+    tag = el.etree_element.tag
+    count = 0
+    for sibling in el.etree_siblings[el.index + 1:]:
+        if sibling.tag == tag:
+            count += 1
+    return count
+
+
+_EVAL_GLOBALS = {
+    '_includes_word': _includes_word,
+    'ascii_lower': ascii_lower,
+    'urlparse': urlparse,
+    '_any_ancestor': _any_ancestor,
+    '_any_previous_sibling': _any_previous_sibling,
+    '_first_of_type': _first_of_type,
+    '_last_of_type': _last_of_type,
+    '_only_of_type': _only_of_type,
+    '_count_previous_of_type': _count_previous_of_type,
+    '_count_next_of_type': _count_next_of_type,
+}
+
+
+# Order of simple selectors tests in compound selectors, other selectors
+# (pseudo-classes, negations…) are tested last.
+_SELECTIVITY = {
+    parser.IDSelector: 0,
+    parser.ClassSelector: 1,
+    parser.LocalNameSelector: 2,
+    parser.NamespaceSelector: 2,
+    parser.AttributeSelector: 3,
+}
+
+
+class _Emit(list):
+    """Intermediate representation of a compiled selector.
+
+    Nodes are tuples whose first item is an operation, they are referenced by
+    their index in the list:
+
+    - ``('expr', source)``: a Python expression,
+    - ``('and', handles)``, ``('or', handles)``, ``('not', handle)``,
+    - ``('combinator', combinator, handle)``: ``handle`` tested on the
+      elements reached from ``el`` through ``combinator``.
+
+    """
+    def add(self, *node):
+        self.append(node)
+        return len(self) - 1
 
 
 def _compile_node(selector):
@@ -80,80 +406,134 @@ def _compile_node(selector):
     tells whether the element is a subject of `selector`.
 
     """
-    # To avoid precedence-related bugs, any sub-expression that is passed
-    # around must be "atomic": add parentheses when the top-level would be
-    # an operator. Bare literals and function calls are fine.
+    emit = _Emit()
+    parts = []
+    _print(emit, _fold(emit, _visit(emit, selector)), parts)
+    return ''.join(parts)
 
-    # 1 and 0 are used for True and False to avoid global lookups.
 
+def _visit(emit, selector):
+    """Add the nodes testing `selector` to `emit`, return their handle."""
     if isinstance(selector, parser.CombinedSelector):
-        left_inside = _compile_node(selector.left)
-        if left_inside == '0':
-            return '0'  # 0 and x == 0
-        elif left_inside == '1':
-            # 1 and x == x, but the element matching 1 still needs to exist.
-            if selector.combinator in (' ', '>'):
-                left = 'el.parent is not None'
-            elif selector.combinator in ('~', '+'):
-                left = 'el.previous is not None'
-            else:
-                raise SelectorError('Unknown combinator', selector.combinator)
-        # Rebind the `el` name inside a generator-expressions (in a new scope)
-        # so that 'left_inside' applies to different elements.
-        elif selector.combinator == ' ':
-            left = 'any((%s) for el in el.ancestors)' % left_inside
-        elif selector.combinator == '>':
-            left = ('next(el is not None and (%s) for el in [el.parent])'
-                    % left_inside)
-        elif selector.combinator == '+':
-            left = ('next(el is not None and (%s) for el in [el.previous])'
-                    % left_inside)
-        elif selector.combinator == '~':
-            left = 'any((%s) for el in el.previous_siblings)' % left_inside
-        else:
+        if selector.combinator not in (' ', '>', '+', '~'):
             raise SelectorError('Unknown combinator', selector.combinator)
-
-        right = _compile_node(selector.right)
-        if right == '0':
-            return '0'  # 0 and x == 0
-        elif right == '1':
-            return left  # 1 and x == x
-        else:
-            # Evaluate combinators right to left:
-            return '(%s) and (%s)' % (right, left)
+        left = emit.add(
+            'combinator', selector.combinator, _visit(emit, selector.left))
+        # Evaluate combinators right to left:
+        return emit.add('and', (_visit(emit, selector.right), left))
 
     elif isinstance(selector, parser.CompoundSelector):
-        sub_expressions = [
-            expr for expr in map(_compile_node, selector.simple_selectors)
-            if expr != '1']
-        if len(sub_expressions) == 1:
-            test = sub_expressions[0]
-        elif '0' in sub_expressions:
-            test = '0'
-        elif sub_expressions:
-            test = ' and '.join('(%s)' % e for e in sub_expressions)
-        else:
-            test = '1'  # all([]) == True
-        return test
+        # Run the most selective and cheapest tests first, so that the
+        # short-circuiting "and" skips the other tests on most elements.
+        simple_selectors = sorted(
+            selector.simple_selectors,
+            key=lambda selector: _SELECTIVITY.get(type(selector), 4))
+        return emit.add('and', tuple(
+            _visit(emit, simple_selector)
+            for simple_selector in simple_selectors))
 
     elif isinstance(selector, parser.NegationSelector):
-        sub_expressions = [
-            expr for expr in map(_compile_node, selector.selector_list)
-            if expr != '1']
-        if not sub_expressions:
-            return '0'
-        return f'not ({" or ".join(f"({expr})" for expr in sub_expressions)})'
+        return emit.add('not', emit.add('or', tuple(
+            _visit(emit, selector) for selector in selector.selector_list)))
 
     elif isinstance(selector, (
             parser.MatchesAnySelector, parser.SpecificityAdjustmentSelector)):
-        sub_expressions = [
-            expr for expr in map(_compile_node, selector.selector_list)
-            if expr != '0']
-        if not sub_expressions:
-            return '0'
-        return ' or '.join(f'({expr})' for expr in sub_expressions)
+        return emit.add('or', tuple(
+            _visit(emit, selector) for selector in selector.selector_list))
 
-    elif isinstance(selector, parser.LocalNameSelector):
+    else:
+        return emit.add('expr', _compile_simple_selector(selector))
+
+
+def _fold(emit, handle):
+    """Fold constants and double negations, return the new handle."""
+    # 1 and 0 are used for True and False to avoid global lookups.
+    node = emit[handle]
+    operation = node[0]
+    if operation in ('and', 'or'):
+        # 0 and x == 0, 1 and x == x, 1 or x == 1, 0 or x == x
+        absorbing, neutral = ('0', '1') if operation == 'and' else ('1', '0')
+        handles = []
+        for child in node[1]:
+            child = _fold(emit, child)
+            if emit[child] == ('expr', absorbing):
+                return child
+            elif emit[child] != ('expr', neutral):
+                handles.append(child)
+        if not handles:
+            return emit.add('expr', neutral)
+        elif len(handles) == 1:
+            return handles[0]
+        return emit.add(operation, tuple(handles))
+    elif operation == 'not':
+        child = _fold(emit, node[1])
+        if emit[child] == ('expr', '0'):
+            return emit.add('expr', '1')
+        elif emit[child] == ('expr', '1'):
+            return emit.add('expr', '0')
+        elif emit[child][0] == 'not':
+            return emit[child][1]
+        return emit.add('not', child)
+    elif operation == 'combinator':
+        combinator = node[1]
+        child = _fold(emit, node[2])
+        if emit[child] == ('expr', '0'):
+            return child
+        elif emit[child] == ('expr', '1'):
+            # The element matching 1 still needs to exist.
+            if combinator in (' ', '>'):
+                return emit.add('expr', 'el.parent is not None')
+            else:
+                return emit.add('expr', 'el.previous is not None')
+        return emit.add('combinator', combinator, child)
+    return handle
+
+
+def _print(emit, handle, parts):
+    """Append the Python source of the node at `handle` to `parts`."""
+    # To avoid precedence-related bugs, operands are always put between
+    # parentheses, expressions must be atomic.
+    node = emit[handle]
+    operation = node[0]
+    if operation == 'expr':
+        parts.append(node[1])
+    elif operation in ('and', 'or'):
+        separator = ') %s (' % operation
+        parts.append('(')
+        for i, child in enumerate(node[1]):
+            if i:
+                parts.append(separator)
+            _print(emit, child, parts)
+        parts.append(')')
+    elif operation == 'not':
+        parts.append('not (')
+        _print(emit, node[1], parts)
+        parts.append(')')
+    elif operation == 'combinator':
+        # Rebind the `el` name inside a lambda (in a new scope) so that the
+        # child applies to different elements.
+        prefix, suffix = _COMBINATOR_TEMPLATES[node[1]]
+        parts.append(prefix)
+        _print(emit, node[2], parts)
+        parts.append(suffix)
+
+
+_COMBINATOR_TEMPLATES = {
+    ' ': ('_any_ancestor(el, lambda el: ', ')'),
+    '>': ('((lambda el: ', ')(el.parent) if el.parent is not None else 0)'),
+    '+': (
+        '((lambda el: ', ')(el.previous) if el.previous is not None else 0)'),
+    '~': ('_any_previous_sibling(el, lambda el: ', ')'),
+}
+
+
+def _compile_simple_selector(selector):
+    """Return the Python source testing a simple selector.
+
+    The source is a boolean expression, as returned by :func:`_compile_node`.
+
+    """
+    if isinstance(selector, parser.LocalNameSelector):
         if selector.lower_local_name == selector.local_name:
             return 'el.local_name == %r' % selector.local_name
         else:
@@ -187,6 +567,10 @@ def _compile_node(selector):
                     key = '(%r if el.in_html_document else %r)' % (
                         selector.lower_name, selector.name)
             value = selector.value
+            # String methods are called on values, and "in" is used for
+            # substrings: binding str.startswith, str.endswith or
+            # str.__contains__ as globals adds a global lookup and is not
+            # faster than method calls, that CPython doesn't bind.
             if selector.operator is None:
                 return '%s in el.etree_element.attrib' % key
             elif selector.operator == '=':
@@ -196,12 +580,12 @@ def _compile_node(selector):
                     return '0'
                 else:
                     return (
-                        '%r in split_whitespace(el.etree_element.get(%s, ""))'
-                        % (value, key))
+                        '_includes_word(el.etree_element.get(%s, ""), %r)'
+                        % (key, value))
             elif selector.operator == '|=':
-                return ('next(v == %r or (v is not None and v.startswith(%r))'
-                        '     for v in [el.etree_element.get(%s)])'
-                        % (value, value + '-', key))
+                return ('((v := el.etree_element.get(%s)) == %r or '
+                        '(v is not None and v.startswith(%r)))'
+                        % (key, value, value + '-'))
             elif selector.operator == '^=':
                 if value:
                     return 'el.etree_element.get(%s, "").startswith(%r)' % (
@@ -280,16 +664,13 @@ def _compile_node(selector):
         elif selector.name == 'last-child':
             return 'el.index + 1 == len(el.etree_siblings)'
         elif selector.name == 'first-of-type':
-            return ('all(s.tag != el.etree_element.tag'
-                    '    for s in el.etree_siblings[:el.index])')
+            return '_first_of_type(el)'
         elif selector.name == 'last-of-type':
-            return ('all(s.tag != el.etree_element.tag'
-                    '    for s in el.etree_siblings[el.index + 1:])')
+            return '_last_of_type(el)'
         elif selector.name == 'only-child':
             return 'len(el.etree_siblings) == 1'
         elif selector.name == 'only-of-type':
-            return ('all(s.tag != el.etree_element.tag or i == el.index'
-                    '    for i, s in enumerate(el.etree_siblings))')
+            return '_only_of_type(el)'
         elif selector.name == 'empty':
             return 'not (el.etree_children or el.etree_element.text)'
         else:
@@ -339,19 +720,21 @@ def _compile_node(selector):
                         'sum(1 for el in'
                         '    tuple(el.iter_siblings())[el.index + 1:]'
                         f'   if ({test}))')
+                # Assignment expressions used by tests are not allowed in
+                # comprehension iterables, siblings are filtered by type first.
                 elif selector.name == 'nth-of-type':
                     count = (
-                        'sum(1 for s in ('
-                        '      el for el in el.previous_siblings'
-                        f'     if ({test}))'
-                        '    if s.etree_element.tag == el.etree_element.tag)')
+                        'sum(1 for el in ['
+                        '      s for s in el.previous_siblings'
+                        '      if s.etree_element.tag == el.etree_element.tag]'
+                        f'   if ({test}))')
                 elif selector.name == 'nth-last-of-type':
                     count = (
-                        'sum(1 for s in ('
-                        '      el for el in'
+                        'sum(1 for el in ['
+                        '      s for s in'
                         '      tuple(el.iter_siblings())[el.index + 1:]'
-                        f'     if ({test}))'
-                        '    if s.etree_element.tag == el.etree_element.tag)')
+                        '      if s.etree_element.tag == el.etree_element.tag]'
+                        f'   if ({test}))')
                 else:
                     raise SelectorError('Unknown pseudo-class', selector.name)
                 count += f'if ({test}) else float("nan")'
@@ -364,11 +747,9 @@ def _compile_node(selector):
                 elif selector.name == 'nth-last-child':
                     count = 'len(el.etree_siblings) - el.index - 1'
                 elif selector.name == 'nth-of-type':
-                    count = ('sum(1 for s in el.etree_siblings[:el.index]'
-                             '    if s.tag == el.etree_element.tag)')
+                    count = '_count_previous_of_type(el)'
                 elif selector.name == 'nth-last-of-type':
-                    count = ('sum(1 for s in el.etree_siblings[el.index + 1:]'
-                             '    if s.tag == el.etree_element.tag)')
+                    count = '_count_next_of_type(el)'
                 else:
                     raise SelectorError('Unknown pseudo-class', selector.name)
 
@@ -385,27 +766,131 @@ def _compile_node(selector):
             if a == 0:
                 # x = B
                 return '(%s) == %i' % (count, B)
+            elif a == 1:
+                # n = x - B >= 0
+                return '(%s) >= %i' % (count, B)
+            elif a == -1:
+                # n = B - x >= 0
+                return '(%s) <= %i' % (count, B)
+            elif 0 < a and B < a:
+                # x is positive or zero, x ≡ B (mod a) is enough for n >= 0
+                # (covers "odd" and "even")
+                return '(%s) %% %i == %i' % (count, a, B % a)
             else:
                 # n = (x - B) / a
-                return ('next(r == 0 and n >= 0'
-                        '     for n, r in [divmod((%s) - %i, %i)])'
-                        % (count, B, a))
+                return '((d := (%s) - %i) %s 0 and d %% %i == 0)' % (
+                    count, B, '>=' if a > 0 else '<=', a)
 
     else:
         raise TypeError(type(selector), selector)
 
 
+def xhtml_tag(local_name):
+    """Return the interned ElementTree tag of an XHTML element."""
+    tag = _xhtml_tags.get(local_name)
+    if tag is None:
+        tag = _xhtml_tags[local_name] = sys.intern(
+            '{%s}%s' % (XHTML_NAMESPACE, local_name))
+    return tag
+
+
 def html_tag_eq(*local_names):
     if len(local_names) == 1:
         return (
             '((el.local_name == %r) if el.in_html_document else '
             '(el.etree_element.tag == %r))' % (
-                local_names[0],
-                '{http://www.w3.org/1999/xhtml}' + local_names[0]))
-    else:
+                local_names[0], xhtml_tag(local_names[0])))
+    elif len(local_names) < 4:
         return (
             '((el.local_name in (%s)) if el.in_html_document else '
             '(el.etree_element.tag in (%s)))' % (
                 ', '.join(repr(n) for n in local_names),
-                ', '.join(repr('{http://www.w3.org/1999/xhtml}' + n)
-                          for n in local_names)))
+                ', '.join(repr(xhtml_tag(n)) for n in local_names)))
+    else:
+        # Membership tests on set displays are compiled to frozenset
+        # constants, with hashed lookups instead of linear scans.
+        return (
+            '((el.local_name in {%s}) if el.in_html_document else '
+            '(el.etree_element.tag in {%s}))' % (
+                ', '.join(repr(n) for n in local_names),
+                ', '.join(repr(xhtml_tag(n)) for n in local_names)))
+
+
+_XPATH_AXES = {
+    ' ': 'ancestor::*',
+    '>': 'parent::*',
+    '+': 'preceding-sibling::*[1]',
+    '~': 'preceding-sibling::*',
+}
+
+
+def _try_xpath(selector):
+    """Return an XPath predicate testing `selector` on the context node.
+
+    Return :obj:`None` if `selector` can't be translated.
+
+    """
+    if isinstance(selector, parser.CombinedSelector):
+        left = _try_xpath(selector.left)
+        right = _try_xpath(selector.right)
+        if left is not None and right is not None:
+            return '(%s) and %s[%s]' % (
+                right, _XPATH_AXES[selector.combinator], left)
+
+    elif isinstance(selector, parser.CompoundSelector):
+        predicates = list(map(_try_xpath, selector.simple_selectors))
+        if None not in predicates:
+            return ' and '.join(
+                '(%s)' % predicate for predicate in predicates) or 'true()'
+
+    elif isinstance(selector, parser.NegationSelector):
+        predicates = list(map(_try_xpath, selector.selector_list))
+        if None not in predicates:
+            return 'not(%s)' % ' or '.join(
+                '(%s)' % predicate for predicate in predicates)
+
+    elif isinstance(selector, (
+            parser.MatchesAnySelector, parser.SpecificityAdjustmentSelector)):
+        predicates = list(map(_try_xpath, selector.selector_list))
+        if None not in predicates:
+            return ' or '.join(
+                '(%s)' % predicate for predicate in predicates) or 'false()'
+
+    elif isinstance(selector, parser.LocalNameSelector):
+        # Case-insensitive names in HTML documents are not supported.
+        if selector.lower_local_name == selector.local_name:
+            return 'local-name() = %s' % _xpath_literal(selector.local_name)
+
+    elif isinstance(selector, parser.NamespaceSelector):
+        return 'namespace-uri() = %s' % _xpath_literal(selector.namespace)
+
+    elif isinstance(selector, parser.ClassSelector):
+        # Class names including whitespace never match, but would be found
+        # in the normalized class attribute.
+        class_name = selector.class_name
+        if split_whitespace(class_name) == [class_name]:
+            return (
+                "contains(concat(' ', normalize-space(@class), ' '), %s)" %
+                _xpath_literal(' %s ' % class_name))
+
+    elif isinstance(selector, parser.IDSelector):
+        return '@id = %s' % _xpath_literal(selector.ident)
+
+    elif isinstance(selector, parser.AttributeSelector):
+        if (selector.namespace == '' and
+                selector.name == selector.lower_name and
+                _xpath_attribute_name(selector.name)):
+            if selector.operator is None:
+                return '@%s' % selector.name
+            elif selector.operator == '=':
+                return '@%s = %s' % (
+                    selector.name, _xpath_literal(selector.value))
+
+
+def _xpath_literal(value):
+    if "'" not in value:
+        return "'%s'" % value
+    elif '"' not in value:
+        return '"%s"' % value
+    else:
+        return "concat('%s')" % "', \"'\", '".join(value.split("'"))
@@ -1,8 +1,9 @@
+import sys
 from warnings import warn
 
 from webencodings import ascii_lower
 
-from .compiler import compile_selector_list, split_whitespace
+from .compiler import SelectorIndex, compile_selector_list, split_whitespace
 
 
 class cached_property:
@@ -231,7 +232,7 @@ class ElementWrapper:
     @staticmethod
     def _compile(selectors):
         return [
-            compiled_selector.test
+            compiled_selector
             for selector in selectors
             for compiled_selector in (
                 [selector] if hasattr(selector, 'test')
@@ -249,7 +250,8 @@ class ElementWrapper:
             or an argument to :func:`compile_selector_list`.
 
         """
-        return any(test(self) for test in self._compile(selectors))
+        return any(
+            selector.test(self) for selector in self._compile(selectors))
 
     def query_all(self, *selectors):
         """
@@ -266,18 +268,48 @@ class ElementWrapper:
             An iterator of newly-created :class:`ElementWrapper` objects.
 
         """
-        tests = self._compile(selectors)
-        if len(tests) == 1:
-            return filter(tests[0], self.iter_subtree())
-        elif selectors:
+        compiled_selectors = self._compile(selectors)
+        etree_elements = self._xpath_query_all(compiled_selectors)
+        if etree_elements is not None:
             return (
-                element
-                for element in self.iter_subtree()
-                if any(test(element) for test in tests)
-            )
+                element for element in self.iter_subtree()
+                if element.etree_element in etree_elements)
+        return self._query_all(compiled_selectors)
+
+    def _query_all(self, selectors):
+        """Return elements matching compiled selectors, without XPath."""
+        if len(selectors) == 1:
+            return filter(selectors[0].test, self.iter_subtree())
+        elif selectors:
+            index = SelectorIndex(selectors)
+            return filter(index.matches, self.iter_subtree())
         else:
             return iter(())
 
+    def _xpath_query_all(self, selectors):
+        """Return the set of etree elements matching selectors, or None.
+
+        XPath queries are only available for lxml elements in XML documents,
+        when all the selectors can be translated into XPath, and when the root
+        of the wrapped tree is the root of the document, as selectors are not
+        scoped to the wrapped tree in XPath. HTML attributes may include form
+        feeds, that are whitespace in CSS but not in XPath.
+
+        """
+        if self.in_html_document or not selectors or any(
+                selector.xpath is None for selector in selectors):
+            return None
+        xpath = getattr(self.etree_element, 'xpath', None)
+        if xpath is None:
+            return None
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        if root.etree_element.getparent() is not None:
+            return None
+        return set(xpath('descendant-or-self::*[%s]' % ' or '.join(
+            '(%s)' % selector.xpath for selector in selectors)))
+
     def query(self, *selectors):
         """Return the first element (in tree order)
         that matches any of the given selectors.
@@ -290,7 +322,9 @@ class ElementWrapper:
             or :obj:`None` if there is no match.
 
         """
-        return next(self.query_all(*selectors), None)
+        # XPath finds all the matching elements, iterate over the tree instead
+        # to stop at the first one.
+        return next(self._query_all(self._compile(selectors)), None)
 
     @cached_property
     def etree_children(self):
@@ -379,12 +413,14 @@ class ElementWrapper:
 
 
 def _split_etree_tag(tag):
+    # Local names are interned, as they are compared with interned local names
+    # of compiled selectors.
     pos = tag.rfind('}')
     if pos == -1:
-        return '', tag
+        return '', sys.intern(tag)
     else:
         assert tag[0] == '{'
-        return tag[1:pos], tag[pos + 1:]
+        return tag[1:pos], sys.intern(tag[pos + 1:])
 
 
 def _parse_content_language(value):
@@ -8,7 +8,9 @@ import xml.etree.ElementTree as etree
 from pathlib import Path
 
 import pytest
-from cssselect2 import ElementWrapper, SelectorError, compile_selector_list
+from cssselect2 import (
+    ElementWrapper, Matcher, SelectorError, SelectorIndex,
+    compile_selector_list, compile_selector_list_all)
 
 from .w3_selectors import invalid_selectors, valid_selectors
 
@@ -78,6 +80,44 @@ def test_valid_selectors(test):
             f'({test["name"]})')
 
 
+def test_compile_cache():
+    selectors = compile_selector_list('div, .a')
+    assert compile_selector_list('div, .a') == selectors
+    assert compile_selector_list('div, .a') is not selectors
+    namespaced_selectors = compile_selector_list(
+        'div, .a', {None: 'http://www.w3.org/1999/xhtml'})
+    assert namespaced_selectors[0] is not selectors[0]
+    assert namespaced_selectors[0].namespace == 'http://www.w3.org/1999/xhtml'
+    assert selectors[0].namespace is None
+    first, second = compile_selector_list('div > p:empty, div>p:EMPTY')
+    assert first.test is second.test
+
+
+def test_test_cache_clear(monkeypatch):
+    from cssselect2 import compiler
+    monkeypatch.setattr(compiler, '_TEST_CACHE_SIZE', 2)
+    monkeypatch.setattr(compiler, '_TEST_CACHE', {})
+    first, = compile_selector_list('div > p:empty')
+    # The cache is cleared while compiling, keep the already cached test
+    selectors = compile_selector_list(
+        'div > p:empty, div > a:empty, div > b:empty')
+    assert selectors[0].test is first.test
+    assert len(compiler._TEST_CACHE) == 2
+
+
+def test_never_matching_selectors():
+    assert compile_selector_list(':hover, a :visited') == []
+    selectors = compile_selector_list_all('div, :hover, p')
+    assert [selector.never_matches for selector in selectors] == [
+        False, True, False]
+    assert compile_selector_list('div, :hover, p') == [
+        selectors[0], selectors[2]]
+    # Unknown pseudo-classes are invalid, even in selectors never matching
+    for selector in (':hover > :linkp', '[href$=".org"]:hover.c > :linkp'):
+        with pytest.raises(SelectorError):
+            compile_selector_list(selector)
+
+
 def test_lang():
     doc = etree.fromstring('''
         <html xmlns="http://www.w3.org/1999/xhtml"></html>
@@ -128,6 +168,7 @@ def test_lang():
     ('a[name]', ['name-anchor']),
     ('a[rel]', ['tag-anchor', 'nofollow-anchor']),
     ('a[rel="tag"]', ['tag-anchor']),
+    ('[rel="tag"]', ['tag-anchor']),
     ('a[href*="localhost"]', ['tag-anchor']),
     ('a[href*=""]', []),
     ('a[href^="http"]', ['tag-anchor', 'nofollow-anchor']),
@@ -169,6 +210,13 @@ def test_lang():
     ('li:nth-child(odd)', ['first-li', 'third-li', 'fifth-li', 'seventh-li']),
     ('li:nth-child(2n+4)', ['fourth-li', 'sixth-li']),
     ('li:nth-child(3n+1)', ['first-li', 'fourth-li', 'seventh-li']),
+    ('li:nth-child(3n-1)', ['second-li', 'fifth-li']),
+    ('li:nth-child(n+3)', [
+        'third-li', 'fourth-li', 'fifth-li', 'sixth-li', 'seventh-li']),
+    ('li:nth-child(-n+2)', ['first-li', 'second-li']),
+    ('li:nth-child(-2n+3)', ['first-li', 'third-li']),
+    ('li:nth-child(3n+4)', ['fourth-li', 'seventh-li']),
+    ('li:nth-child(-2n+5)', ['first-li', 'third-li', 'fifth-li']),
     ('p > input:nth-child(2n of p input[type=checkbox])', [
         'checkbox-disabled', 'checkbox-disabled-checked']),
     ('li:nth-last-child(1)', ['seventh-li']),
@@ -184,6 +232,7 @@ def test_lang():
     (':nth-of-type(1 of .e)', ['tag-anchor', 'first-ol']),
     ('ol:nth-last-of-type(2)', ['first-ol']),
     (':nth-last-of-type(1 of .e)', ['tag-anchor', 'second-ol']),
+    (':nth-of-type(1 of [lang|=En])', ['second-li']),
     ('span:only-child', ['foobar-span']),
     ('div:only-child', ['li-div']),
     ('div *:only-child', ['li-div', 'foobar-span']),
@@ -227,6 +276,7 @@ def test_lang():
         'checkbox-fieldset-disabled', 'area-href']),
     ('a[href]', ['tag-anchor', 'nofollow-anchor']),
     (':not(*)', []),
+    (':not(*, .a)', []),
     ('a:not([href])', ['name-anchor']),
     ('ol :Not([class])', [
         'first-li', 'second-li', 'li-div',
@@ -300,6 +350,89 @@ def test_select(selector, result):
     assert xml_ids == html_ids == result
 
 
+def test_matcher():
+    matcher = Matcher()
+    for payload, selector in enumerate(('#first-li', '.c', 'li', 'ol li')):
+        for compiled_selector in compile_selector_list(selector):
+            matcher.add_selector(compiled_selector, payload)
+    root = ElementWrapper.from_xml_root(IDS_ROOT)
+    results = {
+        element.id: [payload for _, _, _, payload in matcher.match(element)]
+        for element in root.iter_subtree()}
+    assert results['first-li'] == [2, 3, 0]
+    assert results['first-ol'] == [1]
+    assert results['third-li'] == [2, 3, 1]
+    assert results['li-div'] == []
+
+
+def test_selector_index():
+    selectors = compile_selector_list_all(
+        'ol li, #first-li, :hover, .c, LI, *:first-child')
+    index = SelectorIndex(selectors)
+    root = ElementWrapper.from_xml_root(IDS_ROOT)
+    for element in root.iter_subtree():
+        expected = [
+            selector for selector in selectors
+            if not selector.never_matches and selector.test(element)]
+        assert index.match(element) == expected
+        assert index.matches(element) == bool(expected)
+    first_li = root.query('#first-li')
+    assert index.match(first_li) == [selectors[0], selectors[1], selectors[5]]
+
+
+def test_includes_word():
+    doc = etree.fromstring('<html><p foo="ab\u00a0cd\u2003ef gh"/></html>')
+    root = ElementWrapper.from_xml_root(doc)
+    assert root.query('[foo~="gh"]') is not None
+    assert root.query('[foo~="cd"]') is None
+    assert root.query('[foo~="ef"]') is None
+
+
+@pytest.mark.parametrize('selector', (
+    'div', 'div div', 'li > div', 'div + div', 'a ~ a', '.c', '#first-li',
+    'a[rel]', 'a[rel="tag"]', 'ol :not([class])', ':is(div, fieldset)',
+    'li:nth-child(2n)', 'li, li:empty',
+))
+def test_select_lxml(selector):
+    lxml_etree = pytest.importorskip('lxml.etree')
+    lxml_root = lxml_etree.parse(str(CURRENT_FOLDER / 'ids.html')).getroot()
+    # When the body is the wrapped root, its ancestors are ignored by
+    # selectors and XPath can't be used.
+    for etree_root, lxml_root in (
+            (IDS_ROOT.getroot(), lxml_root),
+            (IDS_ROOT.find('.//{*}body'), lxml_root.find('.//{*}body'))):
+        etree_ids = [
+            element.etree_element.get('id', 'nil') for element in
+            ElementWrapper.from_xml_root(etree_root).query_all(selector)]
+        lxml_ids = [
+            element.etree_element.get('id', 'nil') for element in
+            ElementWrapper.from_xml_root(lxml_root).query_all(selector)]
+        assert etree_ids == lxml_ids
+        first = ElementWrapper.from_xml_root(lxml_root).query(selector)
+        assert first.etree_element.get('id', 'nil') == lxml_ids[0]
+
+
+def test_select_lxml_class_whitespace():
+    lxml_etree = pytest.importorskip('lxml.etree')
+    source = '<html><p class="a b"/><p class="a&#9;b"/><p class="a"/></html>'
+    for etree_root in (
+            etree.fromstring(source), lxml_etree.fromstring(source)):
+        root = ElementWrapper.from_xml_root(etree_root)
+        assert list(root.query_all(r'.a\ b')) == []
+        assert list(root.query_all(r'.a\9 b')) == []
+        assert len(list(root.query_all('.a'))) == 3
+
+
+def test_select_lxml_html_form_feed():
+    lxml_html = pytest.importorskip('lxml.html')
+    root = ElementWrapper.from_html_root(lxml_html.document_fromstring(
+        '<html><body><p class="a\fb" id="x"></p></body></html>'))
+    assert [
+        element.etree_element.get('id')
+        for element in root.query_all('.a')] == ['x']
+    assert root.query('.b').etree_element.get('id') == 'x'
+
+
 @pytest.mark.parametrize('selector, result', (
     ('DIV', ['outer-div', 'li-div', 'foobar-div']),
     ('a[NAme]', ['name-anchor']),